@@ -1,15 +1,23 @@
 import os
 import json
+import hashlib
 import logging
 import asyncio
 import time
-from typing import Optional, Any, Dict, List
-from fastapi import FastAPI, Request, status, HTTPException
-from fastapi.responses import JSONResponse, HTMLResponse
-import requests
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Optional, Any, Callable, Dict, List, Tuple
+from fastapi import FastAPI, HTTPException, Header
+from fastapi.responses import HTMLResponse, Response
+from pydantic import BaseModel
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.api_core import retry as retries
+from google.api_core.exceptions import Aborted, AlreadyExists, DeadlineExceeded, InternalServerError, RetryError, ServiceUnavailable
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from math import floor # Для надежных расчетов
 
 # --------------------------
@@ -20,28 +28,87 @@ from math import floor # Для надежных расчетов
 FIREBASE_CONFIG_JSON = os.environ.get('FIREBASE_CONFIG')
 TELEGRAM_TOKEN = os.environ.get('TELEGRAM_TOKEN')
 APP_ID = os.environ.get('__app_id', 'default-app-id')
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper() # В продакшене можно поднять до WARNING
 
 # Setup logging
-logging.basicConfig(level=logging.INFO)
+# Неизвестное имя уровня (опечатка в LOG_LEVEL) не должно ронять воркер при импорте
+_log_level = logging.getLevelName(LOG_LEVEL)
+logging.basicConfig(level=_log_level if isinstance(_log_level, int) else logging.INFO)
 logger = logging.getLogger(__name__)
+if not isinstance(_log_level, int):
+    logger.warning("Unknown LOG_LEVEL %r, falling back to INFO.", LOG_LEVEL)
 
 db = None
+USERS_COL = None # Коллекция пользователей artifacts/{APP_ID}/users (создается один раз)
+
+# Размер общего пула потоков для блокирующих вызовов Firestore SDK (не блокируют event loop)
+FIRESTORE_MAX_WORKERS = 40
+
+# Прогрев при старте: одна попытка без ретраев SDK, чтобы воркер не превысил таймаут Gunicorn (30 с)
+FIRESTORE_WARMUP_TIMEOUT_SEC = 5.0
+
+# Временные ошибки Firestore: клиенту отдается 503 с Retry-After вместо 500.
+# RetryError — SDK исчерпал собственные ретраи на DeadlineExceeded/ServiceUnavailable
+RETRYABLE_FIRESTORE_ERRORS = (Aborted, DeadlineExceeded, ServiceUnavailable, RetryError)
+RETRY_AFTER_HEADERS = {"Retry-After": "1"}
+
+# Чтения на пути запроса: по умолчанию SDK ретраит BatchGetDocuments до 300 с,
+# поэтому ограничиваем и отдельную попытку, и все ретраи вместе
+FIRESTORE_READ_TIMEOUT_SEC = 5.0
+FIRESTORE_READ_RETRY = retries.Retry(
+    initial=0.1,
+    maximum=1.0,
+    multiplier=1.3,
+    predicate=retries.if_exception_type(DeadlineExceeded, InternalServerError, ServiceUnavailable),
+    timeout=10.0,
+)
+
+def _load_firebase_config(raw: str) -> Dict[str, Any]:
+    """Parses the service-account JSON from the environment.
+
+    Корректный JSON разбирается как есть (экранированные \\n в private_key сохраняются).
+    Только если он не парсится, пробуем исправить типичные артефакты вставки в панель
+    хостинга: внешние кавычки и реальные переводы строк внутри PEM-ключа.
+    """
+    try:
+        return json.loads(raw.strip())
+    except json.JSONDecodeError:
+        # strict=False допускает управляющие символы внутри строк: переводы строк в PEM
+        # остаются переводами строк, а между полями JSON они и так просто пробелы
+        cleaned = raw.strip().strip("'\"").replace('\r', '')
+        return json.loads(cleaned, strict=False)
+
 
 def initialize_firebase():
     """Инициализирует Firebase и Firestore клиент."""
-    global db
+    global db, USERS_COL
     try:
         if db is None and FIREBASE_CONFIG_JSON:
-            firebase_config = json.loads(FIREBASE_CONFIG_JSON)
+            firebase_config = _load_firebase_config(FIREBASE_CONFIG_JSON)
             if not firebase_admin._apps:
                 cred = credentials.Certificate(firebase_config)
                 firebase_admin.initialize_app(cred)
                 logger.info("--- Firebase initialized successfully. ---")
             db = firestore.client()
+            USERS_COL = db.collection('artifacts').document(APP_ID).collection('users')
+            # Ссылки, закэшированные для прежнего клиента, больше не действительны
+            get_player_doc_ref.cache_clear()
         elif not FIREBASE_CONFIG_JSON:
             logger.error("--- FIREBASE_CONFIG is missing. Firestore will not be available. ---")
     except Exception as e:
-        logger.error(f"--- ERROR initializing Firebase: {e} ---")
+        logger.error("--- ERROR initializing Firebase: %s ---", e)
+
+
+def warm_up_firestore():
+    """Открывает gRPC-канал Firestore одним небольшим чтением, чтобы первый запрос игрока не ждал рукопожатия."""
+    if db is None:
+        return
+    try:
+        db.collection('artifacts').document(APP_ID).get(retry=None, timeout=FIRESTORE_WARMUP_TIMEOUT_SEC)
+        logger.info("--- Firestore channel warmed up. ---")
+    except Exception as e:
+        # Прогрев необязателен: при ошибке канал откроется на первом запросе
+        logger.warning("--- Firestore warm-up failed: %s ---", e)
 
 # --------------------------
 # 2. GAME DATA AND SETUP
@@ -68,33 +135,72 @@ INDUSTRIES_DICT_BY_INT_ID = {item['id']: item for item in INDUSTRIES_LIST}
 INDUSTRIES_DICT_BY_FRONTEND_ID = {item['frontend_id']: item for item in INDUSTRIES_LIST}
 
 
-# Начальное состояние игрока
+# Начальное состояние игрока (шаблон; используйте get_initial_player_data())
 initial_player_data = {
     "score": 0, # BossCoin (BSS)
     "industries": [], # List of owned industries
-    "last_check_time": int(time.time()), # Timestamp of last login/check
+    "last_check_time": 0, # Timestamp of last login/check (заполняется при создании)
     "total_production": 0, # Total income per cycle time (for display)
     "total_income_per_sec": 0.0, # Общий доход в секунду
 }
 
 
+# Начальный капитал нового игрока
+STARTING_SCORE = 1000
+
+
+def get_initial_player_data() -> Dict[str, Any]:
+    """
+    Returns a fresh initial player state. The timestamp is taken now (not at import time)
+    and the industries list is new, so the template itself is never shared or mutated.
+    """
+    return {**initial_player_data, "industries": [], "last_check_time": int(time.time())}
+
+
 # --------------------------
 # 3. SETUP FASTAPI
 # --------------------------
-app = FastAPI(title="TashBoss Bot API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Гарантирует, что Firestore будет инициализирован до обработки первого запроса."""
+    loop = asyncio.get_running_loop()
+    # Все run_in_executor(None, ...) используют общий пул Firestore; пул принадлежит циклу
+    # и закрывается вместе с ним
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=FIRESTORE_MAX_WORKERS, thread_name_prefix="firestore"))
+    # Разбор ключа и создание клиента блокируют поток, поэтому выполняются вне event loop
+    await loop.run_in_executor(None, initialize_firebase)
+    await loop.run_in_executor(None, warm_up_firestore)
+    yield
+
 
+class ApiCORSMiddleware(CORSMiddleware):
+    """CORSMiddleware that passes exempt paths (HTML page, health probe) straight through."""
+
+    def __init__(self, app, exempt_paths: frozenset = frozenset(), **kwargs):
+        super().__init__(app, **kwargs)
+        self.exempt_paths = exempt_paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in self.exempt_paths:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+app = FastAPI(title="TashBoss Bot API", lifespan=lifespan)
+
+# CORS нужен только игровому API; страницу Mini App и проверку здоровья не обрабатываем
 app.add_middleware(
-    CORSMiddleware,
+    ApiCORSMiddleware,
+    exempt_paths=frozenset({"/", "/health"}),
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
-@app.on_event("startup")
-async def startup_event():
-    """Гарантирует, что Firestore будет инициализирован до обработки первого запроса."""
-    initialize_firebase()
+# Сжатие ответов: index.html (~28 КБ) и /master-data заметно уменьшаются для мобильных клиентов
+app.add_middleware(GZipMiddleware, minimum_size=500)
 
 # --------------------------
 # 4. HELPER FUNCTIONS
@@ -102,11 +208,10 @@ async def startup_event():
 
 # --- Firestore Helpers (Async wrapper for synchronous calls) ---
 
+@lru_cache(maxsize=65536)
 def get_player_doc_ref(user_id: str):
-    """Returns the document reference for a player's game state."""
-    return db.collection(
-        'artifacts', APP_ID, 'users', user_id, 'game_state'
-    ).document('player_doc')
+    """Returns the (cached) document reference for a player's game state."""
+    return USERS_COL.document(user_id).collection('game_state').document('player_doc')
 
 def _fetch_data_sync(user_id: str) -> Dict[str, Any]:
     """Synchronous function to fetch or initialize player data."""
@@ -114,35 +219,153 @@ def _fetch_data_sync(user_id: str) -> Dict[str, Any]:
         raise RuntimeError("Firestore is not initialized.")
         
     doc_ref = get_player_doc_ref(user_id)
-    doc = doc_ref.get()
+    doc = doc_ref.get(retry=FIRESTORE_READ_RETRY, timeout=FIRESTORE_READ_TIMEOUT_SEC)
     
     if doc.exists:
         data = doc.to_dict()
         # Гарантируем наличие необходимых полей, используя merge
-        return {**initial_player_data, **data}
+        return {**get_initial_player_data(), **data}
     else:
         # NOTE: Дадим начальный капитал 
-        initial_with_score = {**initial_player_data, "score": 1000} 
-        doc_ref.set(initial_with_score)
+        initial_with_score = {**get_initial_player_data(), "score": STARTING_SCORE} 
+        try:
+            # create() не перезапишет документ, если его уже создала транзакция (например, первая /buy)
+            doc_ref.create(initial_with_score)
+        except AlreadyExists:
+            return {**get_initial_player_data(), **doc_ref.get(retry=FIRESTORE_READ_RETRY, timeout=FIRESTORE_READ_TIMEOUT_SEC).to_dict()}
         return initial_with_score
 
 async def get_player_state(user_id: str) -> Dict[str, Any]:
-    """Fetches player state asynchronously."""
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, _fetch_data_sync, user_id)
+    """Fetches player state asynchronously (read-only path for /state).
 
-def _save_data_sync(user_id: str, data: Dict):
-    """Synchronous function to save data."""
+    A recent in-process copy may be returned instead of reading Firestore.
+    Endpoints that modify the state go through transact_player_state instead.
+    """
+    cached_state = _get_cached_player_state(user_id)
+    if cached_state is not None:
+        return cached_state
+
+    # Single-flight: одновременные запросы одного игрока ждут уже идущее чтение
+    inflight_fetch = _inflight_fetches.get(user_id)
+    if inflight_fetch is not None:
+        return _copy_player_state(await asyncio.shield(inflight_fetch))
+
+    loop = asyncio.get_running_loop()
+    fetch = loop.run_in_executor(None, _fetch_data_sync, user_id)
+    _inflight_fetches[user_id] = fetch
+    try:
+        # shield: отмена этого запроса не должна отменять чтение для остальных ожидающих
+        player_state = await asyncio.shield(fetch)
+    finally:
+        # Транзакция, зафиксированная во время чтения, снимает его с регистрации
+        # (см. transact_player_state): такой результат уже устарел и в кэш не попадает
+        is_current = _inflight_fetches.get(user_id) is fetch
+        if is_current:
+            del _inflight_fetches[user_id]
+
+    if is_current:
+        _cache_player_state(user_id, player_state)
+    return player_state
+
+def _transact_player_sync(user_id: str, mutate: Callable[[Dict[str, Any]], Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Synchronous load → mutate → save of one player inside a single Firestore transaction.
+    mutate(player_state) changes the state in place and returns only the changed fields;
+    it may run several times on contention, and raising from it aborts without writing.
+    """
     if db is None:
         raise RuntimeError("Firestore is not initialized.")
-        
+
     doc_ref = get_player_doc_ref(user_id)
-    doc_ref.set(data, merge=True)
 
-async def save_player_state(user_id: str, data: Dict):
-    """Saves player state asynchronously."""
-    loop = asyncio.get_event_loop()
-    await loop.run_in_executor(None, _save_data_sync, user_id, data)
+    @firestore.transactional
+    def _run(transaction) -> Dict[str, Any]:
+        snapshot = doc_ref.get(transaction=transaction, retry=FIRESTORE_READ_RETRY, timeout=FIRESTORE_READ_TIMEOUT_SEC)
+        if snapshot.exists:
+            player_state = {**get_initial_player_data(), **snapshot.to_dict()}
+        else:
+            player_state = {**get_initial_player_data(), "score": STARTING_SCORE}
+
+        changed_fields = mutate(player_state)
+
+        if not snapshot.exists:
+            transaction.set(doc_ref, player_state)
+        elif changed_fields:
+            transaction.update(doc_ref, changed_fields)
+        return player_state
+
+    return _run(db.transaction())
+
+async def transact_player_state(user_id: str, mutate: Callable[[Dict[str, Any]], Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Atomically applies mutate to the player's state (see _transact_player_sync).
+    Concurrent requests from other workers can no longer overwrite each other's changes.
+    """
+    loop = asyncio.get_running_loop()
+    # Запросы одного игрока в этом воркере идут по очереди и не создают конфликтов транзакций
+    async with _get_player_lock(user_id):
+        try:
+            player_state = await loop.run_in_executor(None, _transact_player_sync, user_id, mutate)
+        except ValueError as e:
+            # SDK оборачивает последний Aborted в ValueError, когда попытки транзакции исчерпаны
+            if isinstance(e.__cause__, Aborted):
+                raise e.__cause__ from e
+            raise
+
+    # Write-through: кэш сразу видит зафиксированное состояние. Идущее чтение начато
+    # до фиксации, поэтому снимаем его с регистрации: оно не перезапишет свежую запись,
+    # а новые запросы /state не присоединятся к нему
+    _inflight_fetches.pop(user_id, None)
+    _cache_player_state(user_id, player_state)
+    return player_state
+
+
+# user_id -> asyncio.Lock; слабые ссылки, чтобы блокировки без ожидающих удалялись сами
+_player_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def _get_player_lock(user_id: str) -> asyncio.Lock:
+    """Returns the per-player lock that serializes state mutations within this worker."""
+    lock = _player_locks.get(user_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _player_locks[user_id] = lock
+    return lock
+
+
+# --- In-process Player State Cache ---
+
+# Короткий TTL: кэш лишь снимает повторные чтения при частых запросах /state,
+# а другие воркеры Gunicorn увидят изменения не позже чем через TTL.
+STATE_CACHE_TTL_SEC = 5.0
+STATE_CACHE_MAX_SIZE = 10000
+
+# user_id -> (monotonic-время истечения, копия состояния игрока)
+_state_cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+
+# user_id -> Future уже идущего чтения из Firestore; транзакция игрока удаляет запись
+_inflight_fetches: Dict[str, asyncio.Future] = {}
+
+def _copy_player_state(player_state: Dict[str, Any]) -> Dict[str, Any]:
+    """Copies player state deep enough that callers can mutate owned industries safely."""
+    return {**player_state, "industries": [dict(ind) for ind in player_state.get("industries", [])]}
+
+def _cache_player_state(user_id: str, player_state: Dict[str, Any]):
+    """Stores a copy of the player state in the in-process cache."""
+    if user_id not in _state_cache and len(_state_cache) >= STATE_CACHE_MAX_SIZE:
+        # Вытесняем самую старую запись (dict сохраняет порядок вставки)
+        _state_cache.pop(next(iter(_state_cache)))
+    _state_cache[user_id] = (time.monotonic() + STATE_CACHE_TTL_SEC, _copy_player_state(player_state))
+
+def _get_cached_player_state(user_id: str) -> Optional[Dict[str, Any]]:
+    """Returns a copy of the cached player state, or None if it is missing or expired."""
+    cached_entry = _state_cache.get(user_id)
+    if cached_entry is None:
+        return None
+    expires_at, player_state = cached_entry
+    if expires_at < time.monotonic():
+        del _state_cache[user_id]
+        return None
+    return _copy_player_state(player_state)
 
 
 # --- Game Logic Helper ---
@@ -166,7 +389,7 @@ def get_industry_stats(base_data: Dict[str, Any], level: int) -> Dict[str, Any]:
     purchase_cost = base_data['base_cost']
     
     # Производство в секунду (для отображения)
-    production_per_sec = current_income / current_cycle_time if current_cycle_time > 0 else current_income
+    production_per_sec = current_income / current_cycle_time
 
     return {
         "current_income": current_income,
@@ -177,37 +400,53 @@ def get_industry_stats(base_data: Dict[str, Any], level: int) -> Dict[str, Any]:
     }
 
 
-def calculate_accumulated_profit(player_state: Dict[str, Any]) -> int:
+@lru_cache(maxsize=4096)
+def get_industry_stats_by_id(industry_id_int: int, level: int) -> Optional[Dict[str, Any]]:
+    """
+    Cached get_industry_stats() by numeric industry ID and level (None for unknown IDs).
+    Stats depend only on static game data, so each (industry, level) pair is computed
+    once per process. The returned dict is shared and must not be modified.
+    """
+    base_data = INDUSTRIES_DICT_BY_INT_ID.get(industry_id_int)
+    if not base_data:
+        return None
+    return get_industry_stats(base_data, level)
+
+
+def calculate_accumulated_profit(player_state: Dict[str, Any], current_time: Optional[int] = None) -> int:
     """
     Calculates the accumulated profit for all owned industries since the last check
     and updates the player's total production metrics.
+    current_time (UNIX seconds) lets the caller reuse one timestamp for the whole request.
     """
-    current_time = int(time.time())
+    owned_industries = player_state.get('industries')
+    if not owned_industries:
+        # Новый игрок без отраслей: дохода нет, считать нечего
+        player_state['total_income_per_sec'] = 0.0
+        return 0
+
+    if current_time is None:
+        current_time = int(time.time())
     last_check = player_state.get('last_check_time', current_time)
-    time_passed = current_time - last_check
+    time_passed = max(0, current_time - last_check) # Защита от расхождения часов
     
     total_profit = 0
     total_income_per_sec = 0.0
     
-    for owned_industry in player_state.get('industries', []):
-        industry_id_int = owned_industry['id']
-        level = owned_industry.get('level', 1)
-        base_data = INDUSTRIES_DICT_BY_INT_ID.get(industry_id_int)
+    for owned_industry in owned_industries:
+        stats = get_industry_stats_by_id(owned_industry['id'], owned_industry.get('level', 1))
         
-        if not base_data: continue
+        if not stats: continue
 
-        stats = get_industry_stats(base_data, level)
         current_income = stats['current_income']
         current_cycle_time = stats['current_cycle_time']
         
-        # Расчет прибыли
-        if current_cycle_time > 0:
-            cycles_completed = int(time_passed / current_cycle_time)
-            profit = cycles_completed * current_income
-            total_profit += profit
-            
-            # Расчет общего дохода в секунду
-            total_income_per_sec += stats['production_per_sec']
+        # Расчет прибыли (время цикла всегда >= 1, см. get_industry_stats)
+        cycles_completed = time_passed // current_cycle_time
+        total_profit += cycles_completed * current_income
+        
+        # Расчет общего дохода в секунду
+        total_income_per_sec += stats['production_per_sec']
 
     # Обновляем метрики в стейте игрока
     player_state['total_income_per_sec'] = total_income_per_sec
@@ -215,6 +454,56 @@ def calculate_accumulated_profit(player_state: Dict[str, Any]) -> int:
     return total_profit
 
 
+def apply_collected_profit(player_state: Dict[str, Any], profit: int, now: int) -> Dict[str, Any]:
+    """
+    Credits an already calculated profit to the score and resets the timer to now.
+    Returns the changed fields so callers can merge them into a single Firestore update.
+    """
+    player_state["score"] = player_state["score"] + profit
+    player_state["last_check_time"] = now
+    return {"score": player_state["score"], "last_check_time": now}
+
+
+def collect_accumulated_profit(player_state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Credits the accumulated profit to the score and resets the timer in player_state.
+    Returns the changed fields (see apply_collected_profit).
+    """
+    # Одна отметка времени и для расчета прибыли, и для сброса таймера,
+    # чтобы секунды между ними не терялись
+    now = int(time.time())
+    profit = calculate_accumulated_profit(player_state, now)
+    return apply_collected_profit(player_state, profit, now)
+
+
+class StateResponse(BaseModel):
+    """Player state payload returned by all game endpoints (serialized by pydantic-core, not jsonable_encoder)."""
+    user_id: str
+    score: int
+    industries: List[Dict[str, Any]]
+    accumulated_profit: int
+    total_income_per_sec: float
+    last_check_time: int
+
+
+def build_state_response(user_id: str, player_state: Dict[str, Any], accumulated_profit: int) -> Dict[str, Any]:
+    """Builds the player state payload returned by all game endpoints (single place, single pass)."""
+    return {
+        "user_id": user_id,
+        "score": player_state.get('score', 0),
+        "industries": player_state.get('industries', []),
+        "accumulated_profit": accumulated_profit,
+        "total_income_per_sec": player_state.get('total_income_per_sec', 0.0),
+        "last_check_time": player_state.get('last_check_time', int(time.time())),
+    }
+
+
+def storage_unavailable(user_id: str, error: Exception) -> HTTPException:
+    """Logs a transient Firestore error and builds the 503 (with Retry-After) returned to the client."""
+    logger.warning("Firestore temporarily unavailable for %s: %s", user_id, error)
+    return HTTPException(status_code=503, detail="Storage is temporarily unavailable. Please retry.", headers=RETRY_AFTER_HEADERS)
+
+
 # --------------------------
 # 5. FRONTEND (HTML) ENDPOINT
 # --------------------------
@@ -223,28 +512,70 @@ def calculate_accumulated_profit(player_state: Dict[str, Any]) -> int:
 try:
     with open("index.html", "r", encoding="utf-8") as f:
         HTML_CONTENT = f.read()
+    HTML_STATUS = 200
 except FileNotFoundError:
     HTML_CONTENT = "<h1>Error: Mini App HTML file (index.html) not found!</h1>"
+    HTML_STATUS = 500
     logger.error("index.html was not found.")
 
+# Файл статичен в рамках процесса: кодируем один раз и считаем ETag по содержимому,
+# чтобы клиент Telegram мог кэшировать страницу между повторными открытиями
+HTML_BYTES = HTML_CONTENT.encode("utf-8")
+# Слабый ETag: GZipMiddleware отдает сжатое и несжатое представления с одним и тем же тегом
+HTML_ETAG = 'W/"%s"' % hashlib.sha1(HTML_BYTES).hexdigest()[:16]
+HTML_HEADERS = {"Cache-Control": "public, max-age=60", "ETag": HTML_ETAG} if HTML_STATUS == 200 else {}
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Checks an If-None-Match header (list of tags, W/ prefix or '*') against the current ETag."""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag.removeprefix("W/"):
+            return True
+    return False
+
 
 @app.get("/", response_class=HTMLResponse)
-async def serve_mini_app():
+async def serve_mini_app(if_none_match: Optional[str] = Header(None)):
     """Serves the static HTML/JS/CSS file for the Telegram Mini App (the game frontend)."""
-    # NOTE: Файл index.html будет сгенерирован ниже. Здесь заглушка для совместимости
-    return HTML_CONTENT
+    # Страница у клиента не изменилась: 304 без тела
+    if HTML_STATUS == 200 and _etag_matches(if_none_match, HTML_ETAG):
+        return Response(status_code=304, headers=HTML_HEADERS)
+    return HTMLResponse(content=HTML_BYTES, status_code=HTML_STATUS, headers=HTML_HEADERS)
+
+
+def _build_master_data() -> List[Dict[str, Any]]:
+    """Builds the industries list with initial (level 1) stats for the frontend."""
+    master_data = []
+    for item in INDUSTRIES_LIST:
+        stats = get_industry_stats(item, 1) # Уровень 1
+        master_data.append({
+            **item,
+            "initial_income": stats['current_income'],
+            "initial_cycle_sec": stats['current_cycle_time'],
+            "production_per_sec": stats['production_per_sec'],
+        })
+    return master_data
+
+# Мастер-данные статичны, поэтому рассчитываются и кодируются в JSON один раз при загрузке модуля
+MASTER_DATA = _build_master_data()
+MASTER_DATA_JSON = json.dumps(MASTER_DATA, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+@app.get("/health")
+async def health_check():
+    """Lightweight liveness probe for Render (no Firestore or disk access)."""
+    # Состояние Firestore берется из флага инициализации, а не из RPC на каждую проверку;
+    # статус остается 200, чтобы сбой Firestore не приводил к перезапуску воркеров
+    return {"status": "ok", "firestore": "ok" if db is not None else "unavailable"}
 
 
 @app.get("/master-data")
 async def get_master_data():
     """Provides the list of all available industries and costs, including initial stats."""
-    # Добавляем рассчитанные стартовые характеристики для фронтенда
-    for item in INDUSTRIES_LIST:
-        stats = get_industry_stats(item, 1) # Уровень 1
-        item['initial_income'] = stats['current_income']
-        item['initial_cycle_sec'] = stats['current_cycle_time']
-        item['production_per_sec'] = stats['production_per_sec']
-    return INDUSTRIES_LIST
+    return Response(content=MASTER_DATA_JSON, media_type="application/json")
 
 
 # --------------------------
@@ -258,7 +589,7 @@ async def get_master_data():
 # 7. GAME API ENDPOINTS (with Firestore integration)
 # --------------------------
 
-@app.get("/state/{user_id}")
+@app.get("/state/{user_id}", response_model=StateResponse)
 async def get_state(user_id: str):
     """Retrieves the current game state and calculates accumulated profit."""
     try:
@@ -267,53 +598,48 @@ async def get_state(user_id: str):
         # Расчет накопленной прибыли и метрик производства
         accumulated_profit = calculate_accumulated_profit(player_state)
         
-        # Подготовка данных для фронтенда
-        response_data = {
-            "user_id": user_id,
-            "score": player_state.get('score', 0),
-            "industries": player_state.get('industries', []),
-            "accumulated_profit": accumulated_profit,
-            "total_income_per_sec": player_state.get('total_income_per_sec', 0.0),
-            "last_check_time": player_state.get('last_check_time', int(time.time()))
-        }
-        
-        return response_data
+        return build_state_response(user_id, player_state, accumulated_profit)
         
+    except RETRYABLE_FIRESTORE_ERRORS as e:
+        raise storage_unavailable(user_id, e) from e
+
     except Exception as e:
-        logger.error(f"Error retrieving player state {user_id}: {e}")
+        logger.error("Error retrieving player state %s: %s", user_id, e)
         raise HTTPException(status_code=500, detail=f"Failed to load player state. Error: {e}")
 
 
-@app.post("/update/{user_id}")
+@app.post("/update/{user_id}", response_model=StateResponse)
 async def update_profit(user_id: str):
-    """Collects accumulated profit and resets the timer, returning the new state."""
+    """
+    Collects accumulated profit and resets the timer, returning the new state.
+    If no cycle has completed yet, nothing is written and the timer keeps running.
+    """
+
+    def collect(player_state: Dict[str, Any]) -> Dict[str, Any]:
+        # Одна отметка времени и один расчет прибыли и для проверки, и для зачисления
+        now = int(time.time())
+        profit = calculate_accumulated_profit(player_state, now)
+        # Ни один цикл не завершился: записывать нечего, а сброс таймера
+        # только стер бы прогресс незавершенных циклов
+        if profit == 0:
+            return {}
+        return apply_collected_profit(player_state, profit, now)
+
     try:
-        player_state = await get_player_state(user_id)
-        
-        profit = calculate_accumulated_profit(player_state)
-        
-        new_score = player_state["score"] + profit
-        player_state["score"] = new_score
-        player_state["last_check_time"] = int(time.time())
-        
-        await save_player_state(user_id, player_state)
+        player_state = await transact_player_state(user_id, collect)
         
         # Возвращаем полный стейт, как ожидает фронтенд (с 0 накопленной прибыли)
-        return {
-            "user_id": user_id,
-            "score": new_score, 
-            "industries": player_state.get('industries', []),
-            "accumulated_profit": 0, 
-            "total_income_per_sec": player_state.get('total_income_per_sec', 0.0),
-            "last_check_time": player_state.get('last_check_time', int(time.time()))
-        }
+        return build_state_response(user_id, player_state, 0)
+
+    except RETRYABLE_FIRESTORE_ERRORS as e:
+        raise storage_unavailable(user_id, e) from e
 
     except Exception as e:
-        logger.error(f"Error updating profit for {user_id}: {e}")
+        logger.error("Error updating profit for %s: %s", user_id, e)
         raise HTTPException(status_code=500, detail=f"Failed to update profit. Error: {e}")
 
 
-@app.post("/buy/{user_id}/{industry_id_str}")
+@app.post("/buy/{user_id}/{industry_id_str}", response_model=StateResponse)
 async def buy_industry(user_id: str, industry_id_str: str):
     """Allows a player to purchase a new industry (only if not owned)."""
     
@@ -323,9 +649,10 @@ async def buy_industry(user_id: str, industry_id_str: str):
         
     cost = industry_data['base_cost']
     industry_id_int = industry_data['id']
-    
-    try:
-        player_state = await get_player_state(user_id)
+
+    def buy(player_state: Dict[str, Any]) -> Dict[str, Any]:
+        # Сначала зачисляем прибыль, накопленную по текущим отраслям и уровням
+        collected = collect_accumulated_profit(player_state)
         current_score = player_state["score"]
 
         if current_score < cost:
@@ -336,38 +663,39 @@ async def buy_industry(user_id: str, industry_id_str: str):
              raise HTTPException(status_code=400, detail="Industry already owned. Use the /upgrade endpoint.")
 
         # 1. Списание BSS
-        new_score = current_score - cost
+        player_state["score"] = current_score - cost
 
         # 2. Добавление отрасли (инициализация уровня 1)
-        new_industry_instance = {
+        player_state["industries"].append({
             "id": industry_id_int,
             "level": 1,
             "is_responsible_assigned": False,
             "industry_name": industry_data['name'],
             "frontend_id": industry_id_str # Добавляем для удобства
-        }
-        
-        player_state["industries"].append(new_industry_instance)
-        player_state["score"] = new_score
-
-        # 3. Сохранение
-        await save_player_state(user_id, player_state)
+        })
 
-        # 4. Перерасчет общей производственной мощности
-        calculate_accumulated_profit(player_state)
+        # 3. Сбор прибыли и покупка сохраняются одним обновлением
+        return {**collected, "score": player_state["score"], "industries": player_state["industries"]}
+    
+    try:
+        player_state = await transact_player_state(user_id, buy)
 
-        # Возвращаем обновленный стейт
-        return await get_state(user_id)
+        # Возвращаем обновленный стейт прямо из результата транзакции (без повторного чтения)
+        accumulated_profit = calculate_accumulated_profit(player_state)
+        return build_state_response(user_id, player_state, accumulated_profit)
 
-    except HTTPException as http_exc:
-        raise http_exc
+    except HTTPException:
+        raise
         
+    except RETRYABLE_FIRESTORE_ERRORS as e:
+        raise storage_unavailable(user_id, e) from e
+
     except Exception as e:
-        logger.error(f"Error buying industry for {user_id}: {e}")
+        logger.error("Error buying industry for %s: %s", user_id, e)
         raise HTTPException(status_code=500, detail=f"Failed to buy industry. Error: {e}")
 
 
-@app.post("/upgrade/{user_id}/{industry_id_str}")
+@app.post("/upgrade/{user_id}/{industry_id_str}", response_model=StateResponse)
 async def upgrade_industry(user_id: str, industry_id_str: str):
     """Allows a player to upgrade an existing industry."""
     
@@ -376,46 +704,49 @@ async def upgrade_industry(user_id: str, industry_id_str: str):
         raise HTTPException(status_code=404, detail=f"Industry with ID '{industry_id_str}' not found.")
         
     industry_id_int = industry_data['id']
-    
-    try:
-        player_state = await get_player_state(user_id)
+
+    def upgrade(player_state: Dict[str, Any]) -> Dict[str, Any]:
+        # Сначала зачисляем прибыль по старому уровню, иначе прошедшее время
+        # было бы пересчитано уже по новому уровню
+        collected = collect_accumulated_profit(player_state)
         current_score = player_state["score"]
         
         # 1. Ищем существующую отрасль
-        industry_index = next((i for i, ind in enumerate(player_state["industries"]) if ind['id'] == industry_id_int), -1)
+        owned_industry = next((ind for ind in player_state["industries"] if ind['id'] == industry_id_int), None)
         
-        if industry_index == -1:
+        if owned_industry is None:
              raise HTTPException(status_code=400, detail="Industry not owned. You must purchase it first.")
 
-        owned_industry = player_state["industries"][industry_index]
         current_level = owned_industry['level']
         
         # 2. Рассчитываем стоимость улучшения
-        stats = get_industry_stats(industry_data, current_level)
-        upgrade_cost = stats['upgrade_cost']
+        upgrade_cost = get_industry_stats_by_id(industry_id_int, current_level)['upgrade_cost']
 
         if current_score < upgrade_cost:
             raise HTTPException(status_code=400, detail=f"Not enough BossCoin (BSS). Requires {upgrade_cost}, available {current_score}.")
         
         # 3. Применяем улучшение
-        new_score = current_score - upgrade_cost
-        player_state["score"] = new_score
-        player_state["industries"][industry_index]['level'] = current_level + 1
-
-        # 4. Сохранение
-        await save_player_state(user_id, player_state)
+        player_state["score"] = current_score - upgrade_cost
+        owned_industry['level'] = current_level + 1
 
-        # 5. Перерасчет общей производственной мощности
-        calculate_accumulated_profit(player_state)
+        # 4. Сбор прибыли и улучшение сохраняются одним обновлением
+        return {**collected, "score": player_state["score"], "industries": player_state["industries"]}
+    
+    try:
+        player_state = await transact_player_state(user_id, upgrade)
 
-        # Возвращаем обновленный стейт
-        return await get_state(user_id)
+        # Возвращаем обновленный стейт прямо из результата транзакции (без повторного чтения)
+        accumulated_profit = calculate_accumulated_profit(player_state)
+        return build_state_response(user_id, player_state, accumulated_profit)
 
-    except HTTPException as http_exc:
-        raise http_exc
+    except HTTPException:
+        raise
         
+    except RETRYABLE_FIRESTORE_ERRORS as e:
+        raise storage_unavailable(user_id, e) from e
+
     except Exception as e:
-        logger.error(f"Error upgrading industry for {user_id}: {e}")
+        logger.error("Error upgrading industry for %s: %s", user_id, e)
         raise HTTPException(status_code=500, detail=f"Failed to upgrade industry. Error: {e}")
 
 # ... (Остальные заглушки не нужны, так как я заменил все старые /collect /buy) ...
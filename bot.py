@@ -6,6 +6,20 @@ from telegram.ext import Application, CommandHandler, ContextTypes
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
+# --- Клавиатура запуска Mini App ---
+
+def build_start_markup(base_url: str) -> InlineKeyboardMarkup:
+    """Строит клавиатуру с кнопкой запуска Mini App (URL указывает на корневой путь бэкенда)."""
+    keyboard = [
+        [
+            InlineKeyboardButton(
+                "🚀 Запустить TashBoss Clicker",
+                web_app=WebAppInfo(url=base_url)
+            )
+        ]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
 # --- Обработчики команд ---
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -13,29 +27,15 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     if not update.message:
         return
 
-    # BASE_URL теперь должен быть передан в application.bot_data в api.py
-    base_url = context.application.bot_data.get('BASE_URL')
+    # Клавиатура собирается один раз в get_telegram_application (BASE_URL не меняется)
+    reply_markup = context.application.bot_data.get('START_MARKUP')
     
-    if not base_url:
+    if reply_markup is None:
         # Этого не должно случиться, если api.py правильно настроен,
         # но это важная проверка.
         await update.message.reply_text("Ошибка: Не удалось получить базовый URL сервера. Пожалуйста, сообщите администратору.")
         return
 
-    # URL для запуска Mini App. Он должен указывать на корневой путь вашего бэкенда.
-    webapp_url = base_url
-    
-    keyboard = [
-        [
-            InlineKeyboardButton(
-                "🚀 Запустить TashBoss Clicker",
-                web_app=WebAppInfo(url=webapp_url)
-            )
-        ]
-    ]
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
     await update.message.reply_text(
         "Добро пожаловать в TashBoss Clicker! Управляйте городом и зарабатывайте BossCoin.",
         reply_markup=reply_markup,
@@ -49,9 +49,10 @@ def get_telegram_application(bot_token: str, base_url: str) -> Application:
     
     application = Application.builder().token(bot_token).build()
 
-    # Сохраняем BASE_URL в bot_data, чтобы он был доступен в start_command
-    # Используем .application.bot_data, так как Application уже построен
-    application.bot_data['BASE_URL'] = base_url
+    # Неизменяемая клавиатура /start строится один раз, а не на каждую команду;
+    # start_command берет ее из bot_data (Application уже построен)
+    if base_url:
+        application.bot_data['START_MARKUP'] = build_start_markup(base_url)
 
     # Добавляем обработчики
     application.add_handler(CommandHandler("start", start_command))